@@ -1 +1 @@
-from rawimage import read_pgm, read_raw, raw_to_fits
\ No newline at end of file
+from .rawimage import read_pgm, read_ppm, read_raw, raw_to_fits, batch_raw_to_fits
\ No newline at end of file
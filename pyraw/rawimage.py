@@ -1,151 +1,601 @@
 # -*- coding: utf-8 -*-
 
 # System libraries
-from argparse import ArgumentParser
-from copy import deepcopy
 import datetime
 import logging
-import math
+import mmap
 import os
 import re
 import subprocess
-import sys
 
 # Third-party required packages
 import numpy as np
 import pyfits as pf
 
+# FITS files are written in blocks of 2880 bytes; data is streamed out in
+#   chunks of roughly _FITS_CHUNK_BYTES
+_FITS_BLOCK = 2880
+_FITS_CHUNK_BYTES = 4 * 2**20
+
+# Header cards that usually change from one exposure to the next, and the
+#   most recent (fixed cards, _HeaderTemplate) pair cached for each 
+#   (width, height, sample_bytes) image size
+_VARIABLE_CARDS = ('OBSTIME', 'EXPTIME', 'ORIGIN')
+_header_templates = dict()
+
+# How much of dcraw's output to read when looking for the Netpbm header
+_PNM_HEADER_PEEK = 1024
+
+# dcraw arguments for VNG-interpolated PPM and "document mode" PGM output,
+#   both written to stdout
+_DCRAW_INTERPOLATE_ARGS = ["-c","-q","1","-f","-v","-a"]
+_DCRAW_DOCUMENT_ARGS = ["-c","-D","-4"]
+
+# Bytes that may separate tokens in a Netpbm header
+_PNM_WHITESPACE = b" \t\n\r\v\f"
+
+# One pass over the `dcraw -i -v` output picks up every field we need
+_EXIF_RE = re.compile(b"^(?:Timestamp:\\s*(?P<ts>.*)"
+                      b"|Shutter:\\s*(?P<sh>.*?)\\s*sec"
+                      b"|Aperture:\\s*f/(?P<ap>.*)"
+                      b"|ISO speed:\\s*(?P<iso>.*)"
+                      b"|Focal length:\\s*(?P<fl>.*?)\\s*mm"
+                      b"|Filename:\\s*(?P<fn>.*)"
+                      b"|Camera:\\s*(?P<cam>.*)"
+                      b"|Filter pattern:\\s*(?P<bp>.*))$", re.MULTILINE)
+
+def _dcraw(args):
+    """ Run dcraw with the given arguments and return its stdout as bytes. 
+        Anything dcraw prints to stderr (e.g. -v progress messages) is sent
+        to the debug log, and a non-zero exit status raises 
+        subprocess.CalledProcessError.
+    """
+    cmd = ["dcraw"] + list(args)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    _check_dcraw(p, cmd, err)
+    return out
+
+def _check_dcraw(p, cmd, err):
+    """ Log dcraw's stderr and raise if the finished process `p` failed. """
+    if err:
+        logging.debug(err.decode('ascii', 'replace').rstrip())
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+def _parse_pnm_header(buffer, magic):
+    """ Walk a binary Netpbm header once, byte by byte, and return 
+        (width, height, maxval, offset) where offset is the position of the
+        first raster byte. Only the header is ever touched, so a malformed
+        buffer fails fast instead of being scanned end to end, and a raster
+        that happens to start with '#' is never mistaken for a comment.
+    """
+    if buffer[:2] != magic:
+        raise ValueError("Bad magic number")
+    
+    pos = 2
+    values = []
+    while len(values) < 3:
+        c = buffer[pos:pos+1]
+        if not c:
+            raise ValueError("Truncated header")
+        elif c in _PNM_WHITESPACE:
+            pos += 1
+        elif c == b"#":
+            # Comments run to the end of the line
+            while buffer[pos:pos+1] not in (b"\n", b"\r", b""):
+                pos += 1
+        elif c.isdigit():
+            start = pos
+            while buffer[pos:pos+1].isdigit():
+                pos += 1
+            values.append(int(buffer[start:pos]))
+        else:
+            raise ValueError("Unexpected byte {!r} in header".format(c))
+    
+    # Exactly one whitespace byte separates maxval from the raster
+    c = buffer[pos:pos+1]
+    if not c or c not in _PNM_WHITESPACE:
+        raise ValueError("Truncated header")
+    
+    width, height, maxval = values
+    return width, height, maxval, pos+1
+
+def _parse_pnm_bytes(buffer, magic, channels, byteorder='>'):
+    """ Return image data from an in-memory binary Netpbm (P5/P6) buffer. """
+    try:
+        width, height, maxval, offset = _parse_pnm_header(buffer, magic)
+    except ValueError:
+        raise ValueError("Not a raw {} buffer".format("PGM" if channels == 1 else "PPM"))
+    shape = (height, width) if channels == 1 else (height, width, channels)
+    data = np.frombuffer(buffer,
+                            dtype='u1' if maxval < 256 else byteorder+'u2',
+                            count=width*height*channels,
+                            offset=offset
+                            ).reshape(shape)
+    
+    # Swap 16-bit samples into native byte order in a single vectorized pass,
+    #   rather than having every later operation swap on access
+    if not data.dtype.isnative:
+        data = data.byteswap().view(data.dtype.newbyteorder())
+    return data
+
+def _parse_pgm_bytes(buffer, byteorder='>'):
+    """ Return image data from an in-memory raw PGM (P5) buffer. """
+    return _parse_pnm_bytes(buffer, b"P5", 1, byteorder=byteorder)
+
+def _parse_ppm_bytes(buffer, byteorder='>'):
+    """ Return image data from an in-memory raw PPM (P6) buffer. """
+    return _parse_pnm_bytes(buffer, b"P6", 3, byteorder=byteorder)
+
+def _read_pnm(filename, parse, byteorder='>'):
+    """ Memory-map a binary Netpbm file and parse it with `parse`. 8-bit data
+        is returned as a (read-only) view onto the mapping, so pixel data is 
+        only paged in when touched; the mapping stays alive via arr.base. 
+        16-bit data is byte-swapped straight from the mapping into a native
+        byte order array.
+    """
+    with open(filename, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return parse(buffer, byteorder=byteorder)
+
 def read_pgm(filename, byteorder='>'):
     """ Return image data from a raw PGM file as numpy array.
 
         Format specification: http://netpbm.sourceforge.net/doc/pgm.html
+        
+        8-bit images are returned as a read-only view of the file; use .copy()
+        on the result if you need a writable array.
     """
-    with open(filename, 'rb') as f:
-        buffer = f.read()
     try:
-        header, width, height, maxval = re.search(
-            b"(^P5\s(?:\s*#.*[\r\n])*"
-            b"(\d+)\s(?:\s*#.*[\r\n])*"
-            b"(\d+)\s(?:\s*#.*[\r\n])*"
-            b"(\d+)\s(?:\s*#.*[\r\n]\s)*)", buffer).groups()
-    except AttributeError:
+        return _read_pnm(filename, _parse_pgm_bytes, byteorder=byteorder)
+    except ValueError:
         raise ValueError("Not a raw PGM file: '%s'" % filename)
-    return np.frombuffer(buffer,
-                            dtype='u1' if int(maxval) < 256 else byteorder+'u2',
-                            count=int(width)*int(height),
-                            offset=len(header)
-                            ).reshape((int(height), int(width)))
+
+def read_ppm(filename, byteorder='>'):
+    """ Return image data from a raw PPM file as a (height, width, 3) numpy
+        array.
+
+        Format specification: http://netpbm.sourceforge.net/doc/ppm.html
+        
+        8-bit images are returned as a read-only view of the file; use .copy()
+        on the result if you need a writable array.
+    """
+    try:
+        return _read_pnm(filename, _parse_ppm_bytes, byteorder=byteorder)
+    except ValueError:
+        raise ValueError("Not a raw PPM file: '%s'" % filename)
+
+class _ExifReader(object):
+    """ Runs `dcraw -i -v` on a raw file in the background. `wait()` waits for
+        dcraw to finish and returns a dict of the metadata fields matched by 
+        _EXIF_RE, keyed by group name; `close()` kills and reaps dcraw if 
+        `wait()` was never called (and does nothing otherwise). Use it as a
+        context manager to make sure dcraw is always reaped.
+        
+        dcraw only prints this metadata in -i mode, which never decodes the
+        image, so it can't be taken from the same run as the pixel data -- but
+        the two runs can overlap.
+    """
+    def __init__(self, filename):
+        self.cmd = ["dcraw","-i","-v",filename]
+        self._p = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, 
+                                   stderr=subprocess.PIPE)
+        self._reaped = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def wait(self):
+        rawheader, err = self._p.communicate()
+        self._reaped = True
+        _check_dcraw(self._p, self.cmd, err)
+        
+        fields = dict()
+        for m in _EXIF_RE.finditer(rawheader):
+            gd = m.lastgroup
+            fields[gd] = m.group(gd).strip().decode('ascii')
+        return fields
+    
+    def close(self):
+        if self._reaped:
+            return
+        if self._p.poll() is None:
+            try:
+                self._p.kill()
+            except OSError:
+                # It finished in the meantime
+                pass
+        self._p.communicate()
+        self._reaped = True
+
+def _bilinear_demosaic(raw, bayer_str):
+    """ Bilinearly interpolate a Bayer mosaic onto a full (height, width, 3) 
+        RGB grid, entirely with NumPy slicing. Each filter's own samples are
+        kept as they are, and the two missing colors at every pixel are the
+        average of the nearest same-color neighbors: the 2 horizontal or 
+        vertical ones, the 4 orthogonal ones (green at red/blue pixels), or 
+        the 4 diagonal ones (red at blue pixels and vice versa). All the work
+        is done on the quarter-size sub-grids of the 2x2 Bayer cell.
+        
+        Parameters
+        ----------
+        raw : ndarray
+            The 2D mosaic, e.g. as returned by read_raw(..., interpolate=False).
+        bayer_str : str
+            The 2x2 filter pattern in row-major order, e.g. "RGGB".
+    """
+    H, W = raw.shape
+    if H < 2 or W < 2:
+        raise ValueError("Can't demosaic a {}x{} image -- need at least 2x2."
+                         .format(H, W))
+    
+    # Pad by one pixel on each side, reflecting about the edge pixels so that
+    #   the padding keeps the parity of the Bayer pattern
+    padded = np.pad(raw, 1, mode='reflect')
+    
+    def neighbor(r, s, di, dj):
+        """ The (di, dj) neighbors of every pixel in the (r, s) sub-grid """
+        return padded[r+1+di:H+1+di:2, s+1+dj:W+1+dj:2]
+    
+    def average(r, s, offsets):
+        total = np.zeros(neighbor(r, s, 0, 0).shape, dtype=np.float32)
+        for di, dj in offsets:
+            total += neighbor(r, s, di, dj)
+        total *= 1. / len(offsets)
+        return np.rint(total, out=total)
+    
+    horizontal = [(0,-1), (0,1)]
+    vertical = [(-1,0), (1,0)]
+    diagonal = [(-1,-1), (-1,1), (1,-1), (1,1)]
+    
+    rgb = np.empty((H, W, 3), dtype=raw.dtype)
+    for i, f in enumerate(bayer_str):
+        r, s = i//2, i%2
+        for k, c in enumerate("RGB"):
+            if c == f:
+                rgb[r::2, s::2, k] = raw[r::2, s::2]
+            elif c == "G":
+                rgb[r::2, s::2, k] = average(r, s, horizontal + vertical)
+            elif f != "G":
+                rgb[r::2, s::2, k] = average(r, s, diagonal)
+            elif bayer_str[2*r + (1-s)] == c:
+                rgb[r::2, s::2, k] = average(r, s, horizontal)
+            else:
+                rgb[r::2, s::2, k] = average(r, s, vertical)
+    
+    return rgb
 
 def read_raw(filename, interpolate=True):
-    """ Read in a raw image file by using dcraw to convert it to a Netpbm .pgm 
-        file, and then reading in the data from the 16-bit pgm file. 
+    """ Read in a raw image file by using dcraw to convert it to a Netpbm 
+        image written to stdout, and then parsing the data straight from the
+        pipe -- no intermediate .pgm/.ppm file is written to disk.
         
         Parameters
         ----------
         filename : str
             The filename of the RAW file (NEF, CR2) 
+        interpolate : bool or str, optional
+            If True, interpolate the colors onto the same grid using dcraw's 
+            VNG 4-color interpolator. If 'bilinear', use a much faster, 
+            in-process bilinear interpolation of the 16-bit mosaic instead 
+            (see _bilinear_demosaic). If False, return the raw mosaic.
     """
     if not os.path.exists(filename):
         raise IOError("File {} does not exist!".format(filename))
     
-    if interpolate:
+    if interpolate == 'bilinear':
+        with _ExifReader(filename) as exif:
+            raw_data = _parse_pgm_bytes(_dcraw(_DCRAW_DOCUMENT_ARGS + [filename]))
+            raw_data = _bilinear_demosaic(raw_data, exif.wait()['bp'][:4])
+    
+    elif interpolate:
         # Converting the raw to PPM
-        p = subprocess.Popen(["dcraw","-q","1","-f","-v","-a",filename]).communicate()[0]
-        
-        ppm_filename = os.path.splitext(filename)[0] + ".ppm"
-        raw_data = np.array(Image.open(ppm_filename))
+        raw_data = _parse_ppm_bytes(_dcraw(_DCRAW_INTERPOLATE_ARGS + [filename]))
         
     else:
         # Converting the raw to PGM
-        p = subprocess.Popen(["dcraw","-D","-4",filename]).communicate()[0]
-        
-        pgm_filename = os.path.splitext(filename)[0] + ".pgm"
-        raw_data = read_pgm(pgm_filename)
+        raw_data = _parse_pgm_bytes(_dcraw(_DCRAW_DOCUMENT_ARGS + [filename]))
+    
+    # 8-bit data is still a read-only view onto dcraw's (immutable) output,
+    #   which nothing else holds on to, so hand back a writable copy
+    if not raw_data.flags.writeable:
+        raw_data = raw_data.copy()
     
     return raw_data
 
-def raw_to_fits(raw_filename, fits_filename=None, split_channels=False, interpolate=True):
-    """ Convert a raw image file (e.g. NEF or CR2) to a FITS file 
+def _write_fits_data(f, data):
+    """ Stream an image array to an open file as FITS big-endian data, a
+        block of rows at a time, and pad it out to a whole FITS block. Only one
+        chunk is ever byte-swapped in memory, rather than a full copy of the
+        image as with HDUList.writeto.
+    """
+    if data.dtype.kind == 'u' and data.dtype.itemsize > 1:
+        # FITS stores unsigned ints as signed with BZERO = 2**(bits-1); 
+        #   flipping the sign bit gives the same bytes as subtracting BZERO
+        flip = data.dtype.type(1 << (8*data.dtype.itemsize - 1))
+    else:
+        flip = None
+    disk_dtype = data.dtype.newbyteorder('>')
     
-        .. Note:: Right now, this really only supports RGB cameras, like Nikon D40, D90 etc.
-                    or Canon Rebel XT, EOS, etc. 
+    rows = max(1, _FITS_CHUNK_BYTES // max(1, data[:1].nbytes))
+    for ii in range(0, len(data), rows):
+        chunk = data[ii:ii+rows]
+        if flip is not None:
+            chunk = chunk ^ flip
+        np.asarray(chunk, dtype=disk_dtype).tofile(f)
+    
+    f.write(b"\0" * (-data.nbytes % _FITS_BLOCK))
+
+def _write_fits(hdulist, fits_filename):
+    """ Write an HDUList to a new FITS file. Headers are serialized by pyfits,
+        but pixel data is streamed with _write_fits_data so peak memory stays 
+        close to the size of the image itself.
+    """
+    if os.path.exists(fits_filename):
+        raise IOError("File {} already exists!".format(fits_filename))
+    
+    hdulist.update_extend()
+    hdulist.verify('exception')
+    try:
+        with open(fits_filename, 'wb') as f:
+            for hdu in hdulist:
+                data = hdu.data
+                if data is not None and data.dtype.kind == 'u' and data.dtype.itemsize > 1:
+                    hdu.header['BSCALE'] = 1
+                    hdu.header['BZERO'] = 2**(8*data.dtype.itemsize - 1)
+                f.write(hdu.header.tostring().encode('ascii'))
+                if data is not None:
+                    _write_fits_data(f, data)
+    except BaseException:
+        # Don't leave a partial file behind, e.g. when the disk fills up
+        if os.path.exists(fits_filename):
+            os.remove(fits_filename)
+        raise
+
+class _HeaderTemplate(object):
+    """ A serialized FITS header in which the cards that change from file to
+        file (_VARIABLE_CARDS) can be patched in place. A batch of files from
+        the same camera, with the same settings, then only pays for formatting
+        a whole header once.
+    """
+    def __init__(self, header):
+        self.image = bytearray(header.tostring().encode('ascii'))
         
-        Parameters
-        ----------
-        raw_filename : str
-            The filename of the RAW file (NEF, CR2) to be converted.
-        fits_filename : str, optional
-            If 'fits_filename' is specified, the function will save the resultant FITS
-            file into the specified filename. Otherwise, it will return an HDUList object.
-        split_channels : bool, optional
-            If split_channels is True, the FITS file will contain 4 HDUs, one per channel
-            from the RAW image. Otherwise, it will return an HDUList with a single HDU
-            with the same bayer pattern structure. The bayer pattern is read from the 
-            EXIF data.
-        interpolate : bool, optional
-            If True, will interpolate the colors onto the same grid using dcraw's VNG
-            4-color interpolator.
+        # Byte offset and length of each variable card in the header image
+        self.slots = dict()
+        offset = 0
+        for card in header.cards:
+            if card.keyword in _VARIABLE_CARDS:
+                self.slots[card.keyword] = (offset, len(card.image))
+            offset += len(card.image)
+    
+    def render(self, cards):
+        """ Return the header bytes with the given (keyword, value) cards 
+            patched in, or None if a card no longer fits in its slot (e.g. a
+            long string that needs CONTINUE cards).
+        """
+        image = bytearray(self.image)
+        for keyword, value in cards:
+            offset, length = self.slots[keyword]
+            card = pf.Card(keyword, value).image.encode('ascii')
+            if len(card) != length:
+                return None
+            image[offset:offset+length] = card
+        return bytes(image)
+
+def _ppm_fits_header(width, height, sample_bytes, cards):
+    """ Return the serialized FITS header for a (height, width, 3) image with
+        the given metadata cards, reusing the cached _HeaderTemplate for this
+        image size when only the _VARIABLE_CARDS differ from an earlier file.
     """
-    raw_data = read_raw(raw_filename, interpolate=interpolate)
+    fixed = tuple(c for c in cards if c[0] not in _VARIABLE_CARDS)
+    variable = [c for c in cards if c[0] in _VARIABLE_CARDS]
+    key = (width, height, sample_bytes)
+    
+    cached = _header_templates.get(key)
+    if cached is not None and cached[0] == fixed:
+        header = cached[1].render(variable)
+        if header is not None:
+            return header
+    
+    hdu = pf.PrimaryHDU()
+    hdu.header['BITPIX'] = 8*sample_bytes
+    hdu.header['NAXIS'] = 3
+    hdu.header.set('NAXIS1', 3, after='NAXIS')
+    hdu.header.set('NAXIS2', width, after='NAXIS1')
+    hdu.header.set('NAXIS3', height, after='NAXIS2')
+    if sample_bytes > 1:
+        hdu.header['BSCALE'] = 1
+        hdu.header['BZERO'] = 32768
+    hdu.header.extend(cards)
     
-    # Getting the EXIF data with dcraw
-    p = subprocess.Popen(["dcraw","-i","-v",raw_filename],stdout=subprocess.PIPE)
-    rawheader = p.communicate()[0]
+    # Only one template is kept per image size, so the cache can't grow with
+    #   every camera setting seen; if the cached one just didn't fit (e.g. a
+    #   one-off long ORIGIN), keep it for the files that follow
+    if cached is None or cached[0] != fixed:
+        _header_templates[key] = (fixed, _HeaderTemplate(hdu.header))
+    return hdu.header.tostring().encode('ascii')
 
+def _stream_ppm_to_fits(raw_filename, fits_filename, get_cards):
+    """ Interpolate a raw file with dcraw and pipe the resulting PPM straight
+        into a new FITS file, without ever holding the full image in memory.
+        
+        A (height, width, 3) array in C order has exactly the byte layout of
+        PPM's interleaved raster, and both formats are big-endian, so after 
+        translating the header the raster bytes can be copied through as-is 
+        (16-bit samples only need the sign bit flipped for BZERO).
+        `get_cards` is called, once dcraw has started writing, to get the list
+        of metadata cards to add to the header.
+    """
+    if not os.path.exists(raw_filename):
+        raise IOError("File {} does not exist!".format(raw_filename))
+    
+    if os.path.exists(fits_filename):
+        raise IOError("File {} already exists!".format(fits_filename))
+    
+    cmd = ["dcraw"] + _DCRAW_INTERPOLATE_ARGS + [raw_filename]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    def reap():
+        """ Wait for dcraw to exit and return whatever it wrote to stderr """
+        p.stdout.close()
+        err = p.stderr.read()
+        p.wait()
+        return err
+    
+    try:
+        head = p.stdout.read(_PNM_HEADER_PEEK)
+        try:
+            width, height, maxval, offset = _parse_pnm_header(head, b"P6")
+        except ValueError:
+            # If dcraw failed, its exit status and message explain why better
+            #   than the missing header does
+            _check_dcraw(p, cmd, reap())
+            raise ValueError("dcraw did not produce a raw PPM for '%s'" % raw_filename)
+        sample_bytes = 1 if maxval < 256 else 2
+        
+        header = _ppm_fits_header(width, height, sample_bytes, get_cards())
+        
+        nbytes = width*height*3*sample_bytes
+        with open(fits_filename, 'wb') as f:
+            f.write(header)
+            
+            pending = head[offset:offset+nbytes]
+            remaining = nbytes
+            while remaining > 0:
+                # Chunks stay a whole number of samples, since _FITS_CHUNK_BYTES 
+                #   and nbytes are both even
+                want = min(remaining, _FITS_CHUNK_BYTES)
+                if len(pending) < want:
+                    pending += p.stdout.read(want - len(pending))
+                if len(pending) < want:
+                    # Likewise for output that stops short
+                    _check_dcraw(p, cmd, reap())
+                    raise IOError("Truncated dcraw output for '%s'" % raw_filename)
+                chunk, pending = pending[:want], pending[want:]
+                
+                if sample_bytes > 1:
+                    flipped = np.frombuffer(chunk, dtype='>u2') ^ np.uint16(32768)
+                    flipped.astype('>u2').tofile(f)
+                else:
+                    f.write(chunk)
+                remaining -= want
+            
+            f.write(b"\0" * (-nbytes % _FITS_BLOCK))
+    except BaseException:
+        if os.path.exists(fits_filename):
+            os.remove(fits_filename)
+        raise
+    finally:
+        err = reap()
+        p.stderr.close()
+    _check_dcraw(p, cmd, err)
+
+def _exif_cards(fields):
+    """ Turn the metadata fields read by _ExifReader into a list of 
+        (keyword, value) FITS header cards. Returns the cards and the 2x2 
+        Bayer filter pattern string.
+    """
     # Get the Timestamp
-    m = re.search('(?<=Timestamp:).*',rawheader)
-    date1=m.group(0).split()
-    months = { 'Jan' : 1, 'Feb' : 2, 'Mar' : 3, 'Apr' : 4, 'May' : 5, 'Jun' : 6, 'Jul' : 7, 'Aug' : 8, 'Sep' : 9, 'Oct' : 10, 'Nov' : 11, 'Dec' : 12 }
-    date = datetime.datetime(int(date1[4]),months[date1[1]],int(date1[2]),int(date1[3].split(':')[0]),int(date1[3].split(':')[1]),int(date1[3].split(':')[2]))
-    date ='{0:%Y-%m-%d %H:%M:%S}'.format(date)
+    date = datetime.datetime.strptime(fields['ts'], '%a %b %d %H:%M:%S %Y')
+    date = date.strftime('%Y-%m-%d %H:%M:%S')
     logging.debug("Date: {}".format(date))
     
     # Get the Shutter Speed
-    m = re.search('(?<=Shutter:).*(?=sec)',rawheader)
-    shutter = m.group(0).strip()
+    shutter = fields['sh']
     # Get the Aperture
-    m = re.search('(?<=Aperture: f/).*',rawheader)
-    aperture = m.group(0).strip()
+    aperture = fields['ap']
     logging.debug("Aperture: {}".format(aperture))
 
     # Get the ISO Speed
-    m = re.search('(?<=ISO speed:).*',rawheader)
-    iso = m.group(0).strip()
+    iso = fields['iso']
     logging.debug("ISO: {}".format(iso))
 
     # Get the Focal length
-    m = re.search('(?<=Focal length: ).*(?=mm)',rawheader)
-    focal = m.group(0).strip()
+    focal = fields['fl']
     logging.debug("Focal Length: {}".format(focal))
 
     # Get the Original Filename of the cr2
-    m = re.search('(?<=Filename:).*',rawheader)
-    original_file = m.group(0).strip()
+    original_file = fields['fn']
     logging.debug("Original File: {}".format(original_file))
     
     # Get the Camera Type
-    m = re.search('(?<=Camera:).*',rawheader)
-    camera = m.group(0).strip()
+    camera = fields['cam']
     logging.debug("Camera: {}".format(camera))
     
     # Get the bayer pattern
-    m = re.search('(?<=Filter pattern:).*',rawheader)
-    bayer_str = m.group(0).strip()[:4]
-    bayer_pattern = np.array(list(bayer_str)).reshape((2,2))
-    logging.debug("Bayer filter structure: \n{}".format(bayer_pattern))
+    bayer_str = fields['bp'][:4]
+    logging.debug("Bayer filter structure: \n{}\n{}".format(bayer_str[:2], bayer_str[2:]))
+    
+    # All of the metadata cards, to be added to each HDU with one extend()
+    cards = [('OBSTIME', date),
+             ('EXPTIME', shutter),
+             ('APERTUR', aperture),
+             ('ISO', iso),
+             ('FOCAL', focal),
+             ('ORIGIN', original_file),
+             ('CAMERA', camera),
+             ('BAYERPA', bayer_str),
+             ('COMMENT', 'EXPTIME is in seconds.'),
+             ('COMMENT', 'APERTUR is the ratio as in f/APERTUR'),
+             ('COMMENT', 'FOCAL is in mm')]
+    return cards, bayer_str
+
+def raw_to_fits(raw_filename, fits_filename=None, split_channels=False, interpolate=True):
+    """ Convert a raw image file (e.g. NEF or CR2) to a FITS file 
+    
+        .. Note:: Right now, this really only supports RGB cameras, like Nikon D40, D90 etc.
+                    or Canon Rebel XT, EOS, etc. 
+        
+        Parameters
+        ----------
+        raw_filename : str
+            The filename of the RAW file (NEF, CR2) to be converted.
+        fits_filename : str, optional
+            If 'fits_filename' is specified, the function will save the resultant FITS
+            file into the specified filename. Otherwise, it will return an HDUList object.
+        split_channels : bool, optional
+            If split_channels is True, the FITS file will contain 4 HDUs, one per channel
+            from the RAW image. Otherwise, it will return an HDUList with a single HDU
+            with the same bayer pattern structure. The bayer pattern is read from the 
+            EXIF data.
+        interpolate : bool or str, optional
+            If True, will interpolate the colors onto the same grid using dcraw's VNG
+            4-color interpolator. If 'bilinear', will instead use a fast, in-process
+            bilinear interpolation -- handy for quick-look images.
+    """
+    if not os.path.exists(raw_filename):
+        raise IOError("File {} does not exist!".format(raw_filename))
+    
+    # Getting the EXIF data with dcraw, in the background while the pixels
+    #   are decoded
+    with _ExifReader(raw_filename) as exif:
+        # When writing an interpolated image to disk, it can go straight from 
+        #   dcraw's output into the FITS file
+        if interpolate and interpolate != 'bilinear' and fits_filename != None:
+            _stream_ppm_to_fits(raw_filename, fits_filename, 
+                                lambda: _exif_cards(exif.wait())[0])
+            return
+        
+        # For bilinear interpolation, read the mosaic here and demosaic it below,
+        #   since we'll already have the bayer pattern
+        raw_data = read_raw(raw_filename, interpolate=False if interpolate == 'bilinear' else interpolate)
+        
+        cards, bayer_str = _exif_cards(exif.wait())
+    
+    # (row, col) offset of each filter within the 2x2 Bayer cell
+    offsets = dict((c, (i//2, i%2)) for i, c in enumerate(bayer_str))
+    g_positions = [(i//2, i%2) for i, c in enumerate(bayer_str) if c == "G"]
     
     def _update_header(hdu):
-        hdu.header.update('OBSTIME',date)
-        hdu.header.update('EXPTIME',shutter)
-        hdu.header.update('APERTUR',aperture)
-        hdu.header.update('ISO',iso)
-        hdu.header.update('FOCAL',focal)
-        hdu.header.update('ORIGIN',original_file)
-        hdu.header.update('CAMERA',camera)
-        hdu.header.update('BAYERPA', bayer_str)
-        hdu.header.add_comment('EXPTIME is in seconds.')
-        hdu.header.add_comment('APERTUR is the ratio as in f/APERTUR')
-        hdu.header.add_comment('FOCAL is in mm')
+        hdu.header.extend(cards)
+    
+    if interpolate == 'bilinear':
+        raw_data = _bilinear_demosaic(raw_data, bayer_str)
     
     # Split each filter into its own HDU
     
@@ -155,31 +605,40 @@ def raw_to_fits(raw_filename, fits_filename=None, split_channels=False, interpol
         hdulist = pf.HDUList(hdus=[prim_hdu])
         
     elif split_channels:
-        split_map = np.array([[(0,0),(0,1)],[(1,0),(1,1)]])
+        # View the mosaic as a (2, 2, H/2, W/2) stack of sub-grids: one 
+        #   reshape/transpose instead of four separate strided slices. That
+        #   only works for even sizes -- odd-sized mosaics have sub-grids of
+        #   different shapes, so slice those out one at a time
+        H, W = raw_data.shape
+        if H % 2 == 0 and W % 2 == 0:
+            packed = raw_data.reshape(H//2, 2, W//2, 2).transpose(1, 3, 0, 2)
+            channels = dict(((i,j), packed[i,j]) for i,j in [(0,0),(0,1),(1,0),(1,1)])
+        else:
+            channels = dict(((i,j), raw_data[i::2, j::2]) for i,j in [(0,0),(0,1),(1,0),(1,1)])
         
-        a,b = split_map[bayer_pattern == "R"][0]
-        R_data = raw_data[a::2, b::2]
+        a,b = offsets['R']
+        R_data = np.ascontiguousarray(channels[(a,b)])
         R_hdu = pf.PrimaryHDU(R_data)
         _update_header(R_hdu)
-        R_hdu.header.update('FILTER',"R")
+        R_hdu.header['FILTER'] = "R"
         
-        a,b = split_map[bayer_pattern == "G"][0]
-        G1_data = raw_data[a::2, b::2]
+        a,b = g_positions[0]
+        G1_data = np.ascontiguousarray(channels[(a,b)])
         G1_hdu = pf.ImageHDU(G1_data)
         _update_header(G1_hdu)
-        G1_hdu.header.update('FILTER',"G1")
+        G1_hdu.header['FILTER'] = "G1"
         
-        a,b = split_map[bayer_pattern == "G"][1]
-        G2_data = raw_data[a::2, b::2]
+        a,b = g_positions[1]
+        G2_data = np.ascontiguousarray(channels[(a,b)])
         G2_hdu = pf.ImageHDU(G2_data)
         _update_header(G2_hdu)
-        G2_hdu.header.update('FILTER',"G2")
+        G2_hdu.header['FILTER'] = "G2"
         
-        a,b = split_map[bayer_pattern == "B"][0]
-        B_data = raw_data[a::2, b::2]
+        a,b = offsets['B']
+        B_data = np.ascontiguousarray(channels[(a,b)])
         B_hdu = pf.ImageHDU(B_data)
         _update_header(B_hdu)
-        B_hdu.header.update('FILTER',"B")
+        B_hdu.header['FILTER'] = "B"
         
         hdulist = pf.HDUList(hdus=[R_hdu, G1_hdu, G2_hdu, B_hdu])
     
@@ -192,11 +651,56 @@ def raw_to_fits(raw_filename, fits_filename=None, split_channels=False, interpol
         hdulist = pf.HDUList(hdus=[hdu])
     
     if fits_filename != None:
-        hdulist.writeto(fits_filename)
+        _write_fits(hdulist, fits_filename)
     else:
         return hdulist
 
+def _raw_to_fits_worker(args):
+    """ Unpack a (raw_filename, fits_filename, kwargs) tuple for Pool.map """
+    raw_filename, fits_filename, kwargs = args
+    raw_to_fits(raw_filename, fits_filename=fits_filename, **kwargs)
+
+def batch_raw_to_fits(raw_filenames, fits_filenames=None, processes=None, **kwargs):
+    """ Convert many raw image files to FITS files in parallel, one worker
+        process per CPU core by default. Each file is handled independently by
+        raw_to_fits, and the results are only written to disk -- no HDUList
+        objects are passed back between processes.
+        
+        Parameters
+        ----------
+        raw_filenames : list
+            The filenames of the RAW files (NEF, CR2) to be converted.
+        fits_filenames : list, optional
+            Output FITS filenames, one per raw file. By default, each raw file's
+            extension is replaced with '.fits'.
+        processes : int, optional
+            Number of worker processes. Defaults to the number of CPUs.
+        **kwargs
+            Any other keyword arguments are passed to raw_to_fits.
+    """
+    raw_filenames = list(raw_filenames)
+    if fits_filenames is None:
+        fits_filenames = [os.path.splitext(f)[0] + ".fits" for f in raw_filenames]
+    else:
+        fits_filenames = list(fits_filenames)
+    
+    if len(fits_filenames) != len(raw_filenames):
+        raise ValueError("Got {} raw files but {} FITS filenames."
+                         .format(len(raw_filenames), len(fits_filenames)))
+    
+    # Only batch conversions need multiprocessing, so don't import it up front
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        pool.map(_raw_to_fits_worker,
+                 [(r, f, kwargs) for r, f in zip(raw_filenames, fits_filenames)])
+    finally:
+        pool.close()
+        pool.join()
+
 if __name__ == '__main__':
+    from argparse import ArgumentParser
+    
     parser = ArgumentParser(description="")
     parser.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False,
                     help="Be chatty (default = False)")
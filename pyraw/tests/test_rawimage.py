@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+""" Tests for the pure-Python parts of pyraw.rawimage -- none of these need
+    dcraw or a raw file.
+"""
+
+# Third-party required packages
+import numpy as np
+import pyfits as pf
+import pytest
+
+from pyraw import rawimage
+
+
+# ---------------------------------------------------------------------------
+# _parse_pnm_header / _parse_pnm_bytes
+
+def test_parse_pnm_header_comments():
+    buffer = b"P5 # a comment\n# another\r4  3\n#c\n255\nraster"
+    width, height, maxval, offset = rawimage._parse_pnm_header(buffer, b"P5")
+    assert (width, height, maxval) == (4, 3, 255)
+    assert buffer[offset:] == b"raster"
+
+def test_parse_pnm_bytes_raster_starting_with_hash():
+    """ Raster bytes after maxval are never mistaken for a comment """
+    data = np.array([[ord("#"), 10, 13, 32], [1, 2, 3, 4]], dtype=np.uint8)
+    buffer = b"P5\n4 2\n255\n" + data.tobytes()
+    np.testing.assert_array_equal(rawimage._parse_pgm_bytes(buffer), data)
+    
+    data = np.arange(24, dtype='>u2').reshape(2, 4, 3)
+    data[0,0,0] = ord("#") << 8
+    buffer = b"P6\n# comment\n4 2\n65535\n" + data.tobytes()
+    parsed = rawimage._parse_ppm_bytes(buffer)
+    assert parsed.dtype.isnative
+    np.testing.assert_array_equal(parsed, data)
+
+@pytest.mark.parametrize("buffer", [b"", b"P5", b"P5\n4 3", b"P5\n4 3 255",
+                                    b"P6\n4 3 255\n", b"P5\n4 x 255\n"])
+def test_parse_pgm_bytes_bad_header(buffer):
+    with pytest.raises(ValueError):
+        rawimage._parse_pgm_bytes(buffer)
+
+# ---------------------------------------------------------------------------
+# _write_fits / _write_fits_data
+
+def _hdulist(data):
+    return pf.HDUList([pf.PrimaryHDU(data), pf.ImageHDU(data[:3])])
+
+@pytest.mark.parametrize("dtype", ["u2", ">u2", "u1", "i2", "f4"])
+def test_write_fits_matches_writeto(tmpdir, monkeypatch, dtype):
+    """ Streaming the data in (small) chunks gives the same file as pyfits """
+    monkeypatch.setattr(rawimage, "_FITS_CHUNK_BYTES", 100)
+    data = (np.arange(30*40).reshape(30, 40) * 50 % 60000).astype(dtype)
+    
+    expected = str(tmpdir.join("expected.fits"))
+    streamed = str(tmpdir.join("streamed.fits"))
+    _hdulist(data).writeto(expected)
+    rawimage._write_fits(_hdulist(data), streamed)
+    
+    with open(expected, 'rb') as f1:
+        with open(streamed, 'rb') as f2:
+            assert f1.read() == f2.read()
+
+def test_write_fits_no_clobber(tmpdir):
+    filename = str(tmpdir.join("exists.fits"))
+    open(filename, 'w').close()
+    with pytest.raises(IOError):
+        rawimage._write_fits(_hdulist(np.zeros((4, 4))), filename)
+
+def test_write_fits_removes_partial_file(tmpdir, monkeypatch):
+    def fail(f, data):
+        f.write(b"\0" * 100)
+        raise IOError("No space left on device")
+    monkeypatch.setattr(rawimage, "_write_fits_data", fail)
+    
+    filename = str(tmpdir.join("partial.fits"))
+    with pytest.raises(IOError):
+        rawimage._write_fits(_hdulist(np.zeros((4, 4))), filename)
+    assert not tmpdir.join("partial.fits").exists()
+
+# ---------------------------------------------------------------------------
+# _bilinear_demosaic
+
+@pytest.mark.parametrize("bayer_str", ["RGGB", "BGGR", "GRBG", "GBRG"])
+def test_bilinear_demosaic_linear_ramp(bayer_str):
+    """ Bilinear interpolation reproduces a linear ramp exactly away from the
+        edges, and leaves each filter's own pixels untouched.
+    """
+    H, W = 8, 10
+    yy, xx = np.mgrid[:H, :W]
+    truth = dict(R=100 + 3*xx + 5*yy,
+                 G=200 + 2*xx + 1*yy,
+                 B=300 + 1*xx + 4*yy)
+    
+    raw = np.zeros((H, W), dtype=np.uint16)
+    for i, c in enumerate(bayer_str):
+        a, b = i//2, i%2
+        raw[a::2, b::2] = truth[c][a::2, b::2]
+    
+    rgb = rawimage._bilinear_demosaic(raw, bayer_str)
+    assert rgb.shape == (H, W, 3)
+    assert rgb.dtype == raw.dtype
+    
+    for k, c in enumerate("RGB"):
+        np.testing.assert_array_equal(rgb[1:-1, 1:-1, k], truth[c][1:-1, 1:-1])
+        
+        for i, f in enumerate(bayer_str):
+            if f == c:
+                a, b = i//2, i%2
+                np.testing.assert_array_equal(rgb[a::2, b::2, k], raw[a::2, b::2])
+
+@pytest.mark.parametrize("shape", [(1, 6), (6, 1)])
+def test_bilinear_demosaic_too_small(shape):
+    with pytest.raises(ValueError):
+        rawimage._bilinear_demosaic(np.zeros(shape, dtype=np.uint16), "RGGB")
+
+# ---------------------------------------------------------------------------
+# _HeaderTemplate / _ppm_fits_header
+
+def _cards(origin, date='2012-03-03 21:02:11', iso='400'):
+    return [('OBSTIME', date),
+            ('EXPTIME', '30.0'),
+            ('ISO', iso),
+            ('ORIGIN', origin),
+            ('COMMENT', 'EXPTIME is in seconds.')]
+
+def _fresh_header(cards, monkeypatch):
+    monkeypatch.setattr(rawimage, "_header_templates", dict())
+    return rawimage._ppm_fits_header(8, 6, 2, cards)
+
+def test_header_template_render(monkeypatch):
+    monkeypatch.setattr(rawimage, "_header_templates", dict())
+    rawimage._ppm_fits_header(8, 6, 2, _cards('a.CR2'))
+    cached = rawimage._header_templates[(8, 6, 2)]
+    
+    cards = _cards('IMG_0002.CR2', date='2013-01-01 00:00:00')
+    header = rawimage._ppm_fits_header(8, 6, 2, cards)
+    assert rawimage._header_templates[(8, 6, 2)] is cached
+    assert header == _fresh_header(cards, monkeypatch)
+
+def test_header_template_long_origin(monkeypatch):
+    """ A value that needs CONTINUE cards doesn't fit the template, so the
+        header is built from scratch -- but the template is kept.
+    """
+    monkeypatch.setattr(rawimage, "_header_templates", dict())
+    rawimage._ppm_fits_header(8, 6, 2, _cards('a.CR2'))
+    fixed, template = rawimage._header_templates[(8, 6, 2)]
+    
+    cards = _cards('x' * 100)
+    assert template.render([c for c in cards if c[0] in rawimage._VARIABLE_CARDS]) is None
+    
+    header = rawimage._ppm_fits_header(8, 6, 2, cards)
+    assert rawimage._header_templates[(8, 6, 2)][1] is template
+    assert header == _fresh_header(cards, monkeypatch)
+
+def test_header_template_fixed_cards_change(monkeypatch):
+    monkeypatch.setattr(rawimage, "_header_templates", dict())
+    rawimage._ppm_fits_header(8, 6, 2, _cards('a.CR2'))
+    
+    cards = _cards('b.CR2', iso='800')
+    header = rawimage._ppm_fits_header(8, 6, 2, cards)
+    assert len(rawimage._header_templates) == 1
+    assert rawimage._header_templates[(8, 6, 2)][0] == tuple(c for c in cards 
+                                                             if c[0] not in rawimage._VARIABLE_CARDS)
+    assert header == _fresh_header(cards, monkeypatch)
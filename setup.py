@@ -18,5 +18,5 @@ setup(name='pyraw',
       packages=['pyraw'],
       package_data={'pyraw': ['dcraw']},
       cmdclass={"build":my_build},
-      requires=['Numpy (>=1.4)', 'Pyfits (>=3.0)'],
+      requires=['Numpy (>=1.4)', 'Pyfits (>=3.1)'],
      )
\ No newline at end of file